@@ -1,14 +1,23 @@
+import bisect
+import hashlib
+import io
+import json
 import os
 import re
+import sys
 import zipfile
-import xml.etree.ElementTree as ET
 import posixpath
+import tempfile
 import urllib.parse
-import statistics
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree as ET
 
 import tkinter as tk
 from tkinter import filedialog, messagebox
@@ -49,6 +58,15 @@ FRONT_BACK_WORDS = {
     'also by',
 }
 
+# Máximo de palabras de una entrada de FRONT_BACK_WORDS ('table of contents' -> 3)
+_FRONT_BACK_MAX_WORDS = max(len(w.split()) for w in FRONT_BACK_WORDS)
+
+# 'The Index', 'The Notes.', 'The Index, ...': 'the' + entrada, seguida de
+# cualquier cosa que no continúe la palabra (así 'The Covert War' no es 'the cover')
+_THE_FRONT_BACK_RE = re.compile(
+    r"the (?:" + "|".join(sorted(map(re.escape, FRONT_BACK_WORDS), key=len, reverse=True)) + r")(?!\w)"
+)
+
 NUMBER_WORDS_EN = {
     'one', 'two', 'three', 'four', 'five', 'six',
     'seven', 'eight', 'nine', 'ten', 'eleven', 'twelve',
@@ -56,53 +74,105 @@ NUMBER_WORDS_EN = {
     'seventeen', 'eighteen', 'nineteen', 'twenty',
 }
 
+# Caché en disco del TOC + spine ya parseados (se invalida si cambia tamaño o mtime del EPUB).
+# Se guarda en la carpeta de caché del usuario (ver _toc_cache_dir), un .json por libro.
+TOC_CACHE_ENABLED = True
+_TOC_CACHE_VERSION = 1
+
+# Primeras palabras que marcan un capítulo numerado sin necesidad de regex
+_NUM_PREFIX_SET = NUMBER_WORDS_EN | {str(n) for n in range(1, 200)}
+
 # Mínimo de caracteres para considerar que un “capítulo” es real
 MIN_CHARS_PER_CHAPTER = 2000
 
+# Nivel de deflate del ZIP de salida (1 = rápido; para texto apenas comprime menos que 6).
+# Con 0 los capítulos se guardan sin comprimir (ZIP_STORED).
+ZIP_COMPRESSLEVEL = 1
+
+# Capítulos más pequeños que esto se guardan sin comprimir. Solo afecta a textos
+# mínimos: un capítulo de ~2 KB ya se reduce a una fracción al comprimirlo.
+ZIP_STORE_BELOW_BYTES = 128
+
+# Regex compiladas una sola vez (se usan con cada entrada del TOC)
+_ROMAN_RE = re.compile(r'[ivxlcdm]+')
+_ALPHA_RE = re.compile(r'[^a-zA-Z]')
+_CHAPTER_HEAD_RE = re.compile(r'^(chapter|cap[ií]tulo)\s+\w+', re.IGNORECASE)
+_LEAD_DIGIT_RE = re.compile(r'\d+')
+_SAFE_TITLE_RE = re.compile(r"[^a-zA-Z0-9_-]+")
+
+# BOMs con los que libxml2 detecta la codificación por sí mismo
+_ENCODING_BOMS = (b'\xef\xbb\xbf', b'\xff\xfe', b'\xfe\xff')
+# Codificación declarada (<?xml ... encoding=...> o <meta charset=...>); libxml2
+# la ignora en el parser HTML, así que la leemos nosotros del primer KB.
+_DECLARED_ENCODING_RE = re.compile(
+    rb'''<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._:-]+)'''
+    rb'''|<meta[^>]*?charset\s*=\s*["']?([A-Za-z0-9._:-]+)''',
+    re.IGNORECASE)
+
+_OPF_NS = '{http://www.idpf.org/2007/opf}'
+_NCX_NS = '{http://www.daisy.org/z3986/2005/ncx/}'
+
+# Bloques de los que sacamos texto (incluye <div>, necesario para "How To")
+_TEXT_BLOCKS_XPATH = ".//*[self::p or self::li or self::blockquote or self::div]"
+
 
 def normalize(s: str) -> str:
     return " ".join(s.lower().split())
 
 
-def is_definitely_not_chapter(title: str) -> bool:
+def _starts_with_front_back(tokens: List[str]) -> bool:
     """
-    True si parece claramente front/back matter (índice, notas, acknowledgments…)
-    NUNCA marca como falso algo que empiece por 'Chapter...' o 'Capítulo...'.
+    True si las primeras palabras forman una entrada de FRONT_BACK_WORDS,
+    sola o seguida de ' ' o ':' ('notes', 'notes: ...', 'about the author ...').
     """
-    t = normalize(title)
+    for k in range(1, min(len(tokens), _FRONT_BACK_MAX_WORDS) + 1):
+        head = " ".join(tokens[:k])
+        if head in FRONT_BACK_WORDS:
+            return True
+        if ':' in tokens[k - 1] and head.split(':', 1)[0] in FRONT_BACK_WORDS:
+            return True
+    return False
+
 
+def is_definitely_not_chapter_pre(t: str) -> bool:
+    """
+    Igual que is_definitely_not_chapter, pero con el título ya normalizado.
+    """
     if t.startswith('chapter') or t.startswith('capítulo') or t.startswith('capitulo'):
         return False
 
-    for bad in FRONT_BACK_WORDS:
-        if t == bad:
-            return True
-        if t.startswith(bad + ':') or t.startswith(bad + ' '):
-            return True
-        if t.startswith('the ' + bad):
-            return True
+    if t in FRONT_BACK_WORDS:
+        return True
+
+    if _starts_with_front_back(t.split()):
+        return True
+    if _THE_FRONT_BACK_RE.match(t):
+        return True
 
     return False
 
 
+def is_definitely_not_chapter(title: str) -> bool:
+    """
+    True si parece claramente front/back matter (índice, notas, acknowledgments…)
+    NUNCA marca como falso algo que empiece por 'Chapter...' o 'Capítulo...'.
+    """
+    return is_definitely_not_chapter_pre(normalize(title))
+
+
 def is_roman_token(token: str) -> bool:
-    core = re.sub(r'[^a-zA-Z]', '', token).lower()
+    core = _ALPHA_RE.sub('', token).lower()
     if not core or core == 'i':
         return False
-    return bool(re.fullmatch(r'[ivxlcdm]+', core))
+    return bool(_ROMAN_RE.fullmatch(core))
 
 
-def looks_like_numbered_chapter(title: str) -> bool:
+def looks_like_numbered_chapter_pre(t: str) -> bool:
     """
-    Detecta capítulos numerados del estilo:
-      - 'Chapter 1: ...', 'Chapter Two: ...'
-      - 'Capítulo 3 ...'
-      - '1. Algo', 'II Algo', 'One Algo' (si no es front/back).
+    Igual que looks_like_numbered_chapter, pero con el título ya normalizado.
     """
-    t = normalize(title)
-
     # 'Chapter 1', 'Capítulo 3', 'Chapter One'
-    if re.match(r'^(chapter|cap[ií]tulo)\s+\w+', t, re.IGNORECASE):
+    if _CHAPTER_HEAD_RE.match(t):
         return True
 
     tokens = t.split()
@@ -111,59 +181,217 @@ def looks_like_numbered_chapter(title: str) -> bool:
 
     first = tokens[0]
 
-    # '1 Algo', '2.Algo'
-    if re.match(r'\d+', first):
-        if not is_definitely_not_chapter(title):
-            return True
+    # Caso más común, con una sola búsqueda: '1 Algo', '12. Algo', 'One Algo'
+    if first.rstrip(':.') in _NUM_PREFIX_SET:
+        return not is_definitely_not_chapter_pre(t)
 
-    # 'IV Algo'
-    if is_roman_token(first):
-        if not is_definitely_not_chapter(title):
-            return True
-
-    # 'One Algo', 'Two Algo', etc.
-    if first.rstrip(':.') in NUMBER_WORDS_EN:
-        if not is_definitely_not_chapter(title):
-            return True
+    # '2.Algo', '250 Algo' o 'IV Algo'
+    if _LEAD_DIGIT_RE.match(first) or is_roman_token(first):
+        return not is_definitely_not_chapter_pre(t)
 
     return False
 
 
+def looks_like_numbered_chapter(title: str) -> bool:
+    """
+    Detecta capítulos numerados del estilo:
+      - 'Chapter 1: ...', 'Chapter Two: ...'
+      - 'Capítulo 3 ...'
+      - '1. Algo', 'II Algo', 'One Algo' (si no es front/back).
+    """
+    return looks_like_numbered_chapter_pre(normalize(title))
+
+
+def looks_like_part_pre(t: str) -> bool:
+    """
+    Igual que looks_like_part, pero con el título ya normalizado.
+    """
+    return t.startswith('part ')
+
+
 def looks_like_part(title: str) -> bool:
     """
     Detecta 'Part One', 'Part I', 'Part 3: ...' etc.
     """
-    t = normalize(title)
-    return t.startswith('part ')
+    return looks_like_part_pre(normalize(title))
 
 
 # ===================== Lectura OPF + TOC (nav.xhtml / toc.ncx) =====================
 
+def new_html_parsers() -> Dict[Optional[str], lxml.html.HTMLParser]:
+    """
+    Devuelve una caché de parsers por codificación: None detecta por BOM y
+    el resto fuerza la suya (se crean bajo demanda en parse_html_bytes).
+    Sin BOM ni declaración, libxml2 asumiría latin-1, de ahí UTF-8 por defecto.
+    lxml bloquea un parser mientras lo usa: cada hilo necesita los suyos.
+    """
+    return {None: lxml.html.HTMLParser(), 'utf-8': lxml.html.HTMLParser(encoding='utf-8')}
+
+
+# Parsers del hilo principal (los hilos de extracción crean los suyos)
+_HTML_PARSERS = new_html_parsers()
+
+# Opciones para todo XML del EPUB (container, OPF, NCX): sin expandir entidades
+# ni acceder a la red, así un DOCTYPE hostil no puede leer ficheros locales
+# (lxml < 5 resuelve entidades externas por defecto).
+_SAFE_XML_OPTIONS = {'resolve_entities': False, 'no_network': True}
+
+
+def parse_html_bytes(data: bytes, parsers=None):
+    """
+    Parsea un (X)HTML directamente desde los bytes del zip, sin decodificar
+    antes a str. Con BOM decide libxml2; si no, manda la codificación declarada
+    en la cabecera XML o en <meta charset>, y UTF-8 si no se declara ninguna.
+    parsers: caché de new_html_parsers(); obligatoria fuera del hilo principal.
+    """
+    if parsers is None:
+        parsers = _HTML_PARSERS
+    encoding = None
+    if not data.startswith(_ENCODING_BOMS):
+        m = _DECLARED_ENCODING_RE.search(data, 0, 1024)
+        encoding = (m.group(1) or m.group(2)).decode('ascii').lower() if m else 'utf-8'
+    parser = parsers.get(encoding)
+    if parser is None:
+        try:
+            parser = lxml.html.HTMLParser(encoding=encoding)
+        except LookupError:
+            # Codificación desconocida para libxml2: nos quedamos con UTF-8
+            parser = parsers['utf-8']
+        parsers[encoding] = parser
+    return lxml.html.fromstring(data, parser=parser)
+
+
 def find_opf_path(zf: zipfile.ZipFile) -> str:
     """
     Localiza el archivo .opf dentro del EPUB.
     """
     try:
         container_xml = zf.read('META-INF/container.xml')
-        container = ET.fromstring(container_xml)
+        container = ET.fromstring(container_xml, ET.XMLParser(**_SAFE_XML_OPTIONS))
         rootfile_el = container.find('.//{*}rootfile')
         return rootfile_el.attrib['full-path']
     except Exception:
         # Fallbacks típicos
         for cand in ['content.opf', 'OEBPS/content.opf']:
-            if cand in zf.namelist():
+            if cand in zf.NameToInfo:
                 return cand
-        # Último recurso: el primer .opf que encontremos
+        # Último recurso: el primer .opf que encontremos (en el orden del zip)
         for name in zf.namelist():
             if name.lower().endswith('.opf'):
                 return name
     raise RuntimeError("No se encontró archivo OPF en el EPUB")
 
 
+def _free_element(elem) -> None:
+    """
+    Libera un elemento ya procesado durante un iterparse, junto con los
+    hermanos anteriores que siguen colgando del padre (patrón de la FAQ de lxml).
+    """
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def _toc_cache_dir() -> Path:
+    """
+    Carpeta de caché propia del usuario (no el temporal compartido):
+    %LOCALAPPDATA% en Windows, ~/Library/Caches en macOS, $XDG_CACHE_HOME o ~/.cache en el resto.
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "epub_chapter_extractor"
+
+
+def _toc_cache_path(epub_path: str) -> Path:
+    # fsencode: la ruta puede traer bytes no UTF-8 (surrogateescape) y no debe fallar
+    key = hashlib.sha1(os.fsencode(os.path.abspath(epub_path))).hexdigest()[:16]
+    return _toc_cache_dir() / f"epubtoc_{key}.json"
+
+
+def _toc_cache_stamp(epub_path: str) -> List[int]:
+    st = os.stat(epub_path)
+    return [_TOC_CACHE_VERSION, st.st_size, st.st_mtime_ns]
+
+
+def load_cached_toc(epub_path: str):
+    """
+    Devuelve (opf_dir, id_to_href, spine_ids, entries) guardados en una
+    ejecución anterior, o None si no hay caché válida para este EPUB.
+    Se usa JSON y no pickle: leer la caché nunca ejecuta código.
+    """
+    if not TOC_CACHE_ENABLED:
+        return None
+    try:
+        with open(_toc_cache_path(epub_path), "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("stamp") != _toc_cache_stamp(epub_path):
+            return None
+        return cached["opf_dir"], cached["id_to_href"], cached["spine_ids"], cached["entries"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        return None
+
+
+def save_cached_toc(epub_path: str, opf_dir: str, id_to_href: Dict[str, str],
+                    spine_ids: List[str], entries: List[Dict[str, Any]]) -> None:
+    """
+    Guarda el resultado de read_toc_and_spine para reutilizarlo. Los fallos
+    de escritura se ignoran: la caché es solo un atajo.
+    """
+    if not TOC_CACHE_ENABLED:
+        return
+    tmp_path = None
+    try:
+        cache_path = _toc_cache_path(epub_path)
+        cache_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # mkstemp crea el archivo con O_EXCL y nombre aleatorio: no sigue symlinks ajenos
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=cache_path.name, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({
+                "stamp": _toc_cache_stamp(epub_path),
+                "opf_dir": opf_dir,
+                "id_to_href": id_to_href,
+                "spine_ids": spine_ids,
+                "entries": entries,
+            }, f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, ValueError):
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
 def parse_epub_toc_and_spine(epub_path: str):
     """
+    Abre el EPUB y lee OPF + TOC (ver read_toc_and_spine), o los toma de la
+    caché en disco si el EPUB no ha cambiado desde la última vez.
+    Devuelve (zf, opf_dir, id_to_href, spine_ids, entries); zf queda abierto
+    y el llamador debe cerrarlo (también es un context manager: `with zf:`).
+    Si la lectura falla, el zip se cierra antes de propagar el error.
+    """
+    zf = zipfile.ZipFile(epub_path, 'r')
+    cached = load_cached_toc(epub_path)
+    if cached is not None:
+        return (zf, *cached)
+
+    try:
+        opf_dir, id_to_href, spine_ids, entries = read_toc_and_spine(zf)
+    except Exception:
+        zf.close()
+        raise
+    save_cached_toc(epub_path, opf_dir, id_to_href, spine_ids, entries)
+    return zf, opf_dir, id_to_href, spine_ids, entries
+
+
+def read_toc_and_spine(zf: zipfile.ZipFile):
+    """
+    Lee OPF, manifest, spine y TOC de un EPUB ya abierto.
     Devuelve:
-      - zf: ZipFile abierto
       - opf_dir: carpeta del OPF dentro del zip
       - id_to_href: id de manifest -> href XHTML
       - spine_ids: lista de idref en orden de lectura
@@ -176,46 +404,104 @@ def parse_epub_toc_and_spine(epub_path: str):
             'play_order': int (solo si viene de toc.ncx)
           }
     """
-    zf = zipfile.ZipFile(epub_path, 'r')
     opf_rel_path = find_opf_path(zf)
     opf_xml = zf.read(opf_rel_path)
-    root = ET.fromstring(opf_xml)
-    ns = {'opf': 'http://www.idpf.org/2007/opf'}
 
-    manifest_el = root.find('opf:manifest', ns)
-    spine_el = root.find('opf:spine', ns)
+    id_to_href: Dict[str, str] = {}
+    spine_ids: List[str] = []
+    nav_href = None
+    ncx_href = None
+
+    # Leemos manifest y spine en streaming: cada <item>/<itemref> se libera
+    # en cuanto lo procesamos, así la memoria no crece con el tamaño del manifest.
+    for _, elem in ET.iterparse(io.BytesIO(opf_xml), events=('end',),
+                                tag=(_OPF_NS + 'item', _OPF_NS + 'itemref'),
+                                **_SAFE_XML_OPTIONS):
+        if elem.tag == _OPF_NS + 'item':
+            href = elem.attrib['href']
+            id_to_href[elem.attrib['id']] = href
+            if nav_href is None and 'nav' in elem.get('properties', ''):
+                nav_href = href
+            if ncx_href is None and elem.get('media-type') == 'application/x-dtbncx+xml':
+                ncx_href = href
+        else:
+            spine_ids.append(elem.attrib['idref'])
+        _free_element(elem)
 
-    id_to_href = {item.attrib['id']: item.attrib['href'] for item in manifest_el}
     href_to_id = {href: id_ for id_, href in id_to_href.items()}
-    spine_ids = [item.attrib['idref'] for item in spine_el]
     id_to_spine_index = {idref: idx for idx, idref in enumerate(spine_ids)}
     opf_dir = posixpath.dirname(opf_rel_path)
 
     entries: List[Dict[str, Any]] = []
 
     # --- EPUB3: nav.xhtml ---
-    nav_items = [
-        item for item in manifest_el
-        if 'properties' in item.attrib and 'nav' in item.attrib['properties']
-    ]
-
-    if nav_items:
-        nav_href = nav_items[0].attrib['href']
+    if nav_href is not None:
         nav_full = posixpath.join(opf_dir, nav_href) if opf_dir else nav_href
-        nav_html = zf.read(nav_full).decode('utf-8', errors='ignore')
-        soup = BeautifulSoup(nav_html, 'html.parser')
-        toc_nav = soup.find('nav', attrs={'epub:type': 'toc'}) or soup.find('nav')
-
-        if toc_nav:
-            for a in toc_nav.find_all('a'):
-                title = a.get_text(strip=True)
-                href = a.get('href')
-                if not href:
+        nav_html = zf.read(nav_full)
+        try:
+            nav_root = parse_html_bytes(nav_html)
+        except ET.ParserError:
+            # nav.xhtml vacío: sin entradas, así se prueba con toc.ncx
+            nav_root = None
+        # El parser HTML deja 'epub:type' como nombre literal del atributo
+        toc_navs = []
+        if nav_root is not None:
+            toc_navs = (nav_root.xpath("//nav[@*[name()='epub:type']='toc']")
+                        or nav_root.xpath("(//nav)[1]"))
+        anchors = toc_navs[0].xpath(".//a[@href]") if toc_navs else []
+
+        for a in anchors:
+            title = a.text_content().strip()
+            href = a.get('href')
+            if not href:
+                continue
+            href_base = href.split('#')[0]
+            idref = href_to_id.get(href_base)
+            if idref is None:
+                alt1 = 'xhtml/' + href_base
+                alt2 = href_base.split('/', 1)[-1]
+                idref = href_to_id.get(alt1) or href_to_id.get(alt2)
+            if idref is None:
+                continue
+            spine_index = id_to_spine_index.get(idref)
+            if spine_index is None:
+                continue
+
+            entries.append({
+                'title': title,
+                'href': href_base,
+                'id': idref,
+                'spine_index': spine_index,
+            })
+
+    # --- EPUB2: toc.ncx (solo si nav.xhtml no aportó nada) ---
+    if not entries:
+        if ncx_href is not None:
+            ncx_full = posixpath.join(opf_dir, ncx_href) if opf_dir else ncx_href
+            ncx_xml = zf.read(ncx_full)
+            ncx_ns = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
+            # IMPORTANTE: todos los navPoint, incluidos los anidados (Part -> capítulos).
+            # Cada entrada se registra al cerrar su <content> (el navLabel ya está
+            # leído y los navPoint hijos aún no), y cada navPoint se libera al cerrarse.
+            for _, elem in ET.iterparse(io.BytesIO(ncx_xml), events=('end',),
+                                        tag=(_NCX_NS + 'content', _NCX_NS + 'navPoint'),
+                                        **_SAFE_XML_OPTIONS):
+                if elem.tag == _NCX_NS + 'navPoint':
+                    _free_element(elem)
                     continue
-                href_base = href.split('#')[0]
+
+                nav_point = elem.getparent()
+                if nav_point is None or nav_point.tag != _NCX_NS + 'navPoint':
+                    continue
+                text_el = nav_point.find('ncx:navLabel/ncx:text', ncx_ns)
+                title = text_el.text if text_el is not None else ''
+                src = elem.attrib.get('src', '')
+                if not src:
+                    continue
+                href_base = src.split('#')[0]
                 idref = href_to_id.get(href_base)
                 if idref is None:
-                    alt1 = 'xhtml/' + href_base
+                    alt1 = 'text/' + href_base
                     alt2 = href_base.split('/', 1)[-1]
                     idref = href_to_id.get(alt1) or href_to_id.get(alt2)
                 if idref is None:
@@ -223,127 +509,130 @@ def parse_epub_toc_and_spine(epub_path: str):
                 spine_index = id_to_spine_index.get(idref)
                 if spine_index is None:
                     continue
+                play_order = int(nav_point.attrib.get('playOrder', '0') or 0)
 
                 entries.append({
                     'title': title,
                     'href': href_base,
                     'id': idref,
                     'spine_index': spine_index,
+                    'play_order': play_order,
                 })
 
-    # --- EPUB2: toc.ncx (solo si nav.xhtml no aportó nada) ---
-    if not entries:
-        ncx_items = [
-            item for item in manifest_el
-            if item.attrib.get('media-type') == 'application/x-dtbncx+xml'
-        ]
-        if ncx_items:
-            ncx_href = ncx_items[0].attrib['href']
-            ncx_full = posixpath.join(opf_dir, ncx_href) if opf_dir else ncx_href
-            ncx_xml = zf.read(ncx_full)
-            ncx_ns = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
-            ncx_root = ET.fromstring(ncx_xml)
-            nav_map = ncx_root.find('ncx:navMap', ncx_ns)
-
-            if nav_map is not None:
-                # IMPORTANTE: todos los navPoint, incluidos los anidados (Part -> capítulos)
-                for nav_point in nav_map.findall('.//ncx:navPoint', ncx_ns):
-                    text_el = nav_point.find('ncx:navLabel/ncx:text', ncx_ns)
-                    content_el = nav_point.find('ncx:content', ncx_ns)
-                    if content_el is None:
-                        continue
-                    title = text_el.text if text_el is not None else ''
-                    src = content_el.attrib.get('src', '')
-                    if not src:
-                        continue
-                    href_base = src.split('#')[0]
-                    idref = href_to_id.get(href_base)
-                    if idref is None:
-                        alt1 = 'text/' + href_base
-                        alt2 = href_base.split('/', 1)[-1]
-                        idref = href_to_id.get(alt1) or href_to_id.get(alt2)
-                    if idref is None:
-                        continue
-                    spine_index = id_to_spine_index.get(idref)
-                    if spine_index is None:
-                        continue
-                    play_order = int(nav_point.attrib.get('playOrder', '0') or 0)
-
-                    entries.append({
-                        'title': title,
-                        'href': href_base,
-                        'id': idref,
-                        'spine_index': spine_index,
-                        'play_order': play_order,
-                    })
-
     entries.sort(key=lambda e: (e.get('play_order', 0), e['spine_index']))
-    return zf, opf_dir, id_to_href, spine_ids, entries
+    return opf_dir, id_to_href, spine_ids, entries
 
 
 # ===================== Extracción de texto de los XHTML =====================
 
-def extract_text_from_xhtml(zf: zipfile.ZipFile, opf_dir: str, href: str) -> str:
+def _zip_key(path: str) -> str:
+    """
+    Clave normalizada de una ruta del zip: des-escapada (%21 -> '!'),
+    sin '/' inicial y en minúsculas.
+    """
+    return urllib.parse.unquote(path).lstrip("/").lower()
+
+
+def build_zip_index(zf: zipfile.ZipFile) -> Dict[str, zipfile.ZipInfo]:
+    """
+    Índice del directorio central del zip, calculado una sola vez:
+    clave normalizada (ver _zip_key) -> ZipInfo. Solo se usa cuando el href
+    no coincide exactamente con ningún nombre del zip.
+    """
+    index: Dict[str, zipfile.ZipInfo] = {}
+    for zinfo in zf.infolist():
+        index.setdefault(_zip_key(zinfo.filename), zinfo)
+    return index
+
+
+def extract_text_from_xhtml(zf: zipfile.ZipFile, opf_dir: str, href: str,
+                            zip_index: Optional[Dict[str, zipfile.ZipInfo]] = None,
+                            parsers=None) -> str:
     """
     Lee un XHTML del EPUB soportando:
       - rutas normales (OEBPS/...)
       - rutas con %xx (ej. %21 -> '!')
     y extrae texto de <p>, <li>, <blockquote> y <div>.
     Esto último es lo que hace que funcione bien con "How To".
+    zip_index: índice de build_zip_index; conviene pasarlo al llamar en bucle.
+    parsers: caché de new_html_parsers() propia del hilo (ver parse_html_bytes).
     """
-    paths_to_try = []
+    if zip_index is None:
+        zip_index = build_zip_index(zf)
 
     full = posixpath.join(opf_dir, href) if opf_dir else href
-    paths_to_try.append(full)
-    paths_to_try.append(full.lstrip("/"))
-
-    # Versión des-escapada del href (caso %21 -> !, etc.)
-    unquoted_href = urllib.parse.unquote(href)
-    if unquoted_href != href:
-        full_unq = posixpath.join(opf_dir, unquoted_href) if opf_dir else unquoted_href
-        paths_to_try.append(full_unq)
-        paths_to_try.append(full_unq.lstrip("/"))
-
-    # Versión des-escapada de la ruta completa
-    full_unq2 = urllib.parse.unquote(full)
-    paths_to_try.append(full_unq2)
-    paths_to_try.append(full_unq2.lstrip("/"))
-
-    # Quitar duplicados
-    seen = set()
-    ordered_paths = []
-    for p in paths_to_try:
-        if p not in seen:
-            seen.add(p)
-            ordered_paths.append(p)
-
-    html = None
-    for p in ordered_paths:
-        try:
-            html = zf.read(p)
-            break
-        except KeyError:
-            continue
+    full_unq = urllib.parse.unquote(full)
 
-    if html is None:
+    # Primero coincidencias exactas (ruta tal cual y des-escapada, %21 -> '!')
+    zinfo = None
+    for name in (full, full.lstrip("/"), full_unq, full_unq.lstrip("/")):
+        zinfo = zf.NameToInfo.get(name)
+        if zinfo is not None:
+            break
+    if zinfo is None:
+        # Si no, el índice normalizado (sin distinguir mayúsculas)
+        zinfo = zip_index.get(_zip_key(full))
+    if zinfo is None:
+        # Último intento: el mismo archivo directamente junto al OPF
+        base = href.split("/")[-1]
+        zinfo = zip_index.get(_zip_key(posixpath.join(opf_dir, base) if opf_dir else base))
+    if zinfo is None:
         return ""
+    with zf.open(zinfo) as f:
+        html = f.read()
 
-    soup = BeautifulSoup(html, "html.parser")
-    for tag in soup(["script", "style"]):
-        tag.decompose()
+    try:
+        tree = parse_html_bytes(html, parsers)
+    except ET.ParserError:
+        # Documento vacío o ilegible
+        return ""
+    ET.strip_elements(tree, "script", "style", with_tail=False)
 
-    body = soup.body or soup
+    bodies = tree.xpath("//body")
+    body = bodies[0] if bodies else tree
     texts = []
 
     # 👇 Aquí está el cambio importante: también leemos <div>
-    for elem in body.find_all(["p", "li", "blockquote", "div"]):
-        txt = elem.get_text(" ", strip=True)
+    for elem in body.xpath(_TEXT_BLOCKS_XPATH):
+        # itertext() + " " conserva los límites entre nodos (<br/>, <p> dentro de <div>...)
+        txt = " ".join(" ".join(elem.itertext()).split())
         if txt:
             texts.append(txt)
 
     return "\n\n".join(texts)
 
 
+def extract_texts_parallel(epub_path: str, opf_dir: str, hrefs: List[str],
+                           zip_index: Optional[Dict[str, zipfile.ZipInfo]] = None) -> Dict[str, str]:
+    """
+    Extrae el texto de varios XHTML en paralelo (descompresión y parseo
+    sueltan el GIL). Cada hilo abre su propio ZipFile, para no compartir el
+    puntero de lectura del archivo, y sus propios parsers HTML, porque lxml
+    serializa los parseos que usan el mismo parser. Los href repetidos (rangos de spine que
+    se solapan, p. ej. Part + Chapter) se leen y parsean una sola vez.
+
+    Devuelve: href -> texto
+    """
+    unique_hrefs = list(dict.fromkeys(hrefs))
+    local = threading.local()
+    handles: List[zipfile.ZipFile] = []
+
+    def work(href: str) -> str:
+        zf = getattr(local, "zf", None)
+        if zf is None:
+            zf = local.zf = zipfile.ZipFile(epub_path, "r")
+            local.parsers = new_html_parsers()
+            handles.append(zf)
+        return extract_text_from_xhtml(zf, opf_dir, href, zip_index, local.parsers)
+
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            return dict(zip(unique_hrefs, pool.map(work, unique_hrefs)))
+    finally:
+        for zf in handles:
+            zf.close()
+
+
 # ===================== División en capítulos usando el TOC =====================
 
 def split_epub_by_toc(epub_path: str, mode: str = "auto") -> List[Dict[str, Any]]:
@@ -355,13 +644,18 @@ def split_epub_by_toc(epub_path: str, mode: str = "auto") -> List[Dict[str, Any]
       - 'auto'  : si hay >=3 numeradas, usa solo esas; si no, usa 'loose'.
     """
     zf, opf_dir, id_to_href, spine_ids, entries = parse_epub_toc_and_spine(epub_path)
-    if not entries:
-        return []
+    # Del zip principal solo necesitamos el índice: los hilos de extracción
+    # abren sus propios handles, así que lo cerramos ya.
+    with zf:
+        if not entries:
+            return []
+        zip_index = build_zip_index(zf)
 
     for e in entries:
-        e["is_numbered"] = looks_like_numbered_chapter(e["title"])
-        e["is_front_back"] = is_definitely_not_chapter(e["title"])
-        e["is_part"] = looks_like_part(e["title"])
+        t = normalize(e["title"])
+        e["is_numbered"] = looks_like_numbered_chapter_pre(t)
+        e["is_front_back"] = is_definitely_not_chapter_pre(t)
+        e["is_part"] = looks_like_part_pre(t)
 
     # Elegimos qué entradas se considerarán capítulos
     if mode == "strict":
@@ -384,42 +678,67 @@ def split_epub_by_toc(epub_path: str, mode: str = "auto") -> List[Dict[str, Any]
     if not chapter_entries:
         return []
 
-    chapters: List[Dict[str, Any]] = []
+    # Rango de spine de cada capítulo (sin repetir rangos): acaba donde empieza
+    # la siguiente entrada del TOC, que buscamos por bisección.
+    boundaries = sorted({e["spine_index"] for e in entries})
+    chapter_ranges = []
     seen_ranges = set()
 
     for entry in chapter_entries:
         start = entry["spine_index"]
-        later_entries = [e for e in entries if e["spine_index"] > start]
-        end = min(e["spine_index"] for e in later_entries) if later_entries else len(spine_ids)
+        idx = bisect.bisect_right(boundaries, start)
+        end = boundaries[idx] if idx < len(boundaries) else len(spine_ids)
         spine_range = (start, end)
         if spine_range in seen_ranges:
             continue
+        seen_ranges.add(spine_range)
+        chapter_ranges.append((entry, spine_range))
+
+    # Extraemos de una vez (y en paralelo) todos los XHTML que hacen falta
+    needed_hrefs = [
+        id_to_href[spine_ids[idx]]
+        for _, (start, end) in chapter_ranges
+        for idx in range(start, end)
+    ]
+    texts_by_href = extract_texts_parallel(epub_path, opf_dir, needed_hrefs, zip_index)
 
+    chapters: List[Dict[str, Any]] = []
+
+    for entry, spine_range in chapter_ranges:
+        start, end = spine_range
         text_parts = []
         for idx in range(start, end):
             idref = spine_ids[idx]
             href = id_to_href[idref]
-            chunk = extract_text_from_xhtml(zf, opf_dir, href)
-            if chunk.strip():
+            # extract_text_from_xhtml ya devuelve el texto normalizado, sin
+            # espacios sobrantes en los extremos: basta con saltar los vacíos
+            chunk = texts_by_href[href]
+            if chunk:
                 text_parts.append(chunk)
 
-        full_text = "\n\n".join(text_parts).strip()
-        if not full_text:
+        if not text_parts:
             continue
+        full_text = "\n\n".join(text_parts)
 
         chapters.append({
             "title": entry["title"],
             "text": full_text,
             "spine_range": spine_range,
         })
-        seen_ranges.add(spine_range)
 
     if not chapters:
         return []
 
     # Filtro por tamaño: primero algo razonable, luego por mediana si fuera necesario
-    lengths = [len(ch["text"]) for ch in chapters]
-    median = statistics.median(lengths) if lengths else 0
+    # Mediana a mano (misma definición que statistics.median, sin su sobrecoste)
+    lengths = sorted(len(ch["text"]) for ch in chapters)
+    mid = len(lengths) // 2
+    if not lengths:
+        median = 0
+    elif len(lengths) % 2:
+        median = lengths[mid]
+    else:
+        median = (lengths[mid - 1] + lengths[mid]) / 2
 
     long_chapters = [ch for ch in chapters if len(ch["text"]) >= MIN_CHARS_PER_CHAPTER]
     if long_chapters:
@@ -444,12 +763,101 @@ def split_epub(epub_path: str, mode: str = "auto") -> List[Dict[str, Any]]:
 
 # ===================== Guardar capítulos en TXT + ZIP =====================
 
-def save_chapters_to_txt_and_zip(epub_path: str, zip_too: bool = True, mode: str = "auto"):
+class _PrecompressedDeflate:
+    """
+    Sustituto del compresor interno de zipfile para una entrada cuyo deflate
+    ya se calculó en otro hilo: descarta lo que recibe y entrega el resultado
+    al cerrar. zipfile sigue calculando CRC y tamaños y escribiendo cabeceras.
+    """
+
+    def __init__(self, compressed: bytes):
+        self._compressed = compressed
+
+    def compress(self, data) -> bytes:
+        return b""
+
+    def flush(self) -> bytes:
+        return self._compressed
+
+
+def _raw_deflate(data: bytes, level: int) -> bytes:
+    # Deflate "crudo" (sin cabecera zlib), que es lo que va dentro de un ZIP
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zip_accepts_precompressed() -> bool:
+    """
+    True si el zipfile de esta versión de Python tiene el compresor interno
+    que sustituimos con _PrecompressedDeflate (se comprueba con un ZIP en memoria).
+    """
+    with zipfile.ZipFile(io.BytesIO(), "w") as probe:
+        zinfo = zipfile.ZipInfo("probe")
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        with probe.open(zinfo, "w") as w:
+            return getattr(w, "_compressor", None) is not None
+
+
+_ZIP_ACCEPTS_PRECOMPRESSED = _zip_accepts_precompressed()
+
+
+def write_zip_members(z: zipfile.ZipFile, members: List[Tuple[str, bytes]],
+                      compresslevel: int = ZIP_COMPRESSLEVEL) -> None:
+    """
+    Añade (arcname, datos) al ZIP. El deflate de cada capítulo se hace en
+    paralelo (zlib suelta el GIL) y luego las entradas se escriben en orden.
+    Los capítulos pequeños, o todos si compresslevel == 0, van sin comprimir,
+    igual que los que no se reducen al comprimirlos.
+    Si zipfile no permite inyectar el deflate ya hecho, comprime él, en serie.
+    """
+    date_time = time.localtime(time.time())[:6]
+
+    def new_zinfo(arcname: str, compress_type: int) -> zipfile.ZipInfo:
+        zinfo = zipfile.ZipInfo(arcname, date_time=date_time)
+        zinfo.compress_type = compress_type
+        zinfo.external_attr = 0o600 << 16
+        return zinfo
+
+    def stored(data: bytes) -> bool:
+        return compresslevel == 0 or len(data) < ZIP_STORE_BELOW_BYTES
+
+    if not _ZIP_ACCEPTS_PRECOMPRESSED:
+        for arcname, data in members:
+            if stored(data):
+                z.writestr(new_zinfo(arcname, zipfile.ZIP_STORED), data)
+            else:
+                z.writestr(new_zinfo(arcname, zipfile.ZIP_DEFLATED), data,
+                           compresslevel=compresslevel)
+        return
+
+    to_deflate = [data for _, data in members if not stored(data)]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        deflated = pool.map(lambda d: _raw_deflate(d, compresslevel), to_deflate)
+
+    for arcname, data in members:
+        compressed = None if stored(data) else next(deflated)
+        if compressed is None or len(compressed) >= len(data):
+            z.writestr(new_zinfo(arcname, zipfile.ZIP_STORED), data)
+            continue
+
+        zinfo = new_zinfo(arcname, zipfile.ZIP_DEFLATED)
+        zinfo.file_size = len(data)
+        with z.open(zinfo, "w") as w:
+            w._compressor = _PrecompressedDeflate(compressed)
+            w.write(data)
+
+
+def save_chapters_to_txt_and_zip(epub_path: str, zip_too: bool = True, mode: str = "auto",
+                                 txt_too: bool = True,
+                                 zip_compresslevel: int = ZIP_COMPRESSLEVEL):
     """
     Extrae capítulos, guarda cada uno en un .txt en una carpeta junto al EPUB,
     y opcionalmente crea también un .zip con todos.
+    Con txt_too=False no se escriben los .txt sueltos: solo el .zip
+    (que se genera directamente desde memoria, sin releer los .txt).
+    zip_compresslevel: nivel de deflate del .zip (1-9; 0 = sin comprimir).
 
-    Devuelve: (chapters, out_dir, zip_path | None)
+    Devuelve: (chapters, out_dir | None, zip_path | None)
     """
     epub_path = os.path.abspath(epub_path)
     chapters = split_epub(epub_path, mode=mode)
@@ -459,37 +867,54 @@ def save_chapters_to_txt_and_zip(epub_path: str, zip_too: bool = True, mode: str
 
     base_dir = os.path.dirname(epub_path)
     base_name = Path(epub_path).stem
-    out_dir = os.path.join(base_dir, base_name + "_chapters")
-    os.makedirs(out_dir, exist_ok=True)
+    out_dir_name = base_name + "_chapters"
+    out_dir = os.path.join(base_dir, out_dir_name)
+    if txt_too:
+        os.makedirs(out_dir, exist_ok=True)
 
-    txt_paths = []
+    # (nombre de archivo, contenido ya codificado) para el ZIP
+    zip_members = []
 
     for ch in chapters:
         num = ch["number"]
         title = ch["title"]
-        safe_title = re.sub(r"[^a-zA-Z0-9_-]+", "_", title)[:60].strip("_")
+        safe_title = _SAFE_TITLE_RE.sub("_", title)[:60].strip("_")
         if not safe_title:
             safe_title = f"chapter_{num}"
 
-        filename = os.path.join(out_dir, f"{num:02d}_{safe_title}.txt")
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(title + "\n\n")
-            f.write(ch["text"])
-        txt_paths.append(filename)
+        filename = f"{num:02d}_{safe_title}.txt"
+        # Se codifica una sola vez; los mismos bytes van al .txt y al .zip
+        data = (title + "\n\n" + ch["text"]).encode("utf-8")
+        if txt_too:
+            Path(out_dir, filename).write_bytes(data)
+        if zip_too:
+            zip_members.append((filename, data))
 
     zip_path = None
     if zip_too:
         zip_path = os.path.join(base_dir, base_name + "_chapters.zip")
-        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as z:
-            for p in txt_paths:
-                arcname = os.path.join(os.path.basename(out_dir), os.path.basename(p))
-                z.write(p, arcname=arcname)
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=zip_compresslevel or None) as z:
+            write_zip_members(
+                z,
+                [(os.path.join(out_dir_name, filename), data) for filename, data in zip_members],
+                zip_compresslevel,
+            )
 
-    return chapters, out_dir, zip_path
+    return chapters, (out_dir if txt_too else None), zip_path
 
 
 # ===================== GUI con Tkinter =====================
 
+# Opciones de compresión del ZIP que ofrece la GUI: (etiqueta, nivel)
+ZIP_LEVEL_LABELS = [
+    ("rápida", 1),
+    ("normal", 6),
+    ("máxima", 9),
+    ("sin comprimir", 0),
+]
+
+
 def run_gui():
     root = tk.Tk()
     root.title("EPUB → capítulos TXT")
@@ -497,6 +922,7 @@ def run_gui():
     epub_path_var = tk.StringVar()
     mode_var = tk.StringVar(value="auto")   # auto / strict / loose
     zip_var = tk.BooleanVar(value=True)
+    zip_level_var = tk.StringVar(value=ZIP_LEVEL_LABELS[0][0])
     status_var = tk.StringVar(value="Selecciona un EPUB y pulsa «Extraer capítulos».")
 
     def choose_epub():
@@ -527,6 +953,7 @@ def run_gui():
                 str(epub_path_obj),
                 zip_too=zip_var.get(),
                 mode=mode_var.get(),
+                zip_compresslevel=dict(ZIP_LEVEL_LABELS)[zip_level_var.get()],
             )
         except Exception as e:
             messagebox.showerror("Error", f"Ocurrió un error procesando el EPUB:\n{e}")
@@ -572,17 +999,23 @@ def run_gui():
         frame, text="Crear ZIP con los capítulos", variable=zip_var
     ).grid(row=2, column=1, sticky="w", padx=5, pady=5)
 
-    # Fila 3: botón de acción
+    # Fila 3: compresión del ZIP
+    tk.Label(frame, text="Compresión del ZIP:").grid(row=3, column=0, sticky="w")
+    tk.OptionMenu(frame, zip_level_var, *(label for label, _ in ZIP_LEVEL_LABELS)).grid(
+        row=3, column=1, sticky="w", padx=5, pady=5
+    )
+
+    # Fila 4: botón de acción
     tk.Button(
         frame,
         text="Extraer capítulos",
         command=extract_chapters_gui,
         width=20
-    ).grid(row=3, column=1, pady=10)
+    ).grid(row=4, column=1, pady=10)
 
-    # Fila 4: estado
+    # Fila 5: estado
     tk.Label(frame, textvariable=status_var, justify="left", fg="gray").grid(
-        row=4, column=0, columnspan=3, sticky="w", pady=5
+        row=5, column=0, columnspan=3, sticky="w", pady=5
     )
 
     frame.columnconfigure(1, weight=1)